@@ -5,6 +5,11 @@
 # ENV:
 #   GROQ_API_KEY=sk_...                  (in backend/.env)
 #   GROQ_MODEL=llama-3.3-70b-versatile   (optional override; default set below)
+#   GROQ_POOL_MAXSIZE=64                 (optional; max keep-alive sockets to Groq)
+#
+# Run:
+#   python app.py                        (local dev server)
+#   gunicorn -c gunicorn.conf.py app:app (production; gevent workers)
 #
 # Endpoints:
 #   POST /api/chat              -> { messages: [{role, content}, ...] }
@@ -16,14 +21,36 @@
 # - Temperature=0.2, max_tokens=800, model configurable via env.
 # - Verifies upstream response first; if Groq returns 4xx/5xx, relays JSON error.
 # - Streams plain text chunks; frontend reads via fetch ReadableStream.
+# - Messages are built canonically (fixed order, content never re-stripped) so
+#   repeated turns share a byte-identical prefix for Groq's prompt caching.
+# - Replies replayed from the response cache are gzip- or zstd-encoded (zstd
+#   needs the optional `zstandard` package) when the client advertises support;
+#   live streams go out uncompressed, as their small chunks don't compress.
 
+import hashlib
 import json
 import os
-from typing import Generator, List, Dict, Any
+import re
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Generator, Iterator, List, Dict, Optional, Tuple
 from flask import Flask, request, Response
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError, SSLError
+from werkzeug.exceptions import HTTPException
+
+try:
+    import zstandard  # optional: enables zstd-encoded streams
+except ImportError:
+    zstandard = None
 
-app = Flask(__name__)
+# API-only app: no static folder, so no /static route to match against.
+app = Flask(__name__, static_folder=None)
 
 def load_dotenv_manual():
     """
@@ -33,19 +60,15 @@ def load_dotenv_manual():
       GROQ_MODEL=llama-3.3-70b-versatile
     """
     env_path = os.path.join(os.path.dirname(__file__), ".env")
-    if not os.path.exists(env_path):
-        return
     try:
-        with open(env_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith("#") or "=" not in line:
-                    continue
-                k, v = line.split("=", 1)
-                k = k.strip()
-                v = v.strip().strip('"').strip("'")
-                if k and k not in os.environ:
-                    os.environ[k] = v
+        with open(env_path, "rb") as f:
+            lines = f.read().decode("utf-8").splitlines()
+        env: Dict[str, str] = {}
+        for k, sep, v in (line.strip().partition("=") for line in lines):
+            k = k.strip()
+            if sep and k and not k.startswith("#"):
+                env.setdefault(k, v.strip().strip('"').strip("'"))  # first one wins
+        os.environ.update({k: v for k, v in env.items() if k not in os.environ})
     except Exception:
         pass
 
@@ -56,30 +79,179 @@ MODEL = os.environ.get("GROQ_MODEL", "llama-3.3-70b-versatile")  # configurable
 TEMPERATURE = 0.2
 MAX_TOKENS = 800
 BASE_URL = "https://api.groq.com/openai/v1"
+# Rough cap on forwarded conversation history (estimated at ~4 chars/token);
+# oldest turns are dropped first. Selection and popup turns are never trimmed.
+HISTORY_TOKEN_BUDGET = 4000
+POOL_MAXSIZE = int(os.environ.get("GROQ_POOL_MAXSIZE", "64"))
 
-def add_cors_headers(resp: Response) -> Response:
-    resp.headers["Access-Control-Allow-Origin"] = "*"
-    resp.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    resp.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-    return resp
+# Upstream SSE framing, matched on raw bytes to skip a decode per frame.
+SSE_DATA_PREFIX = b"data: "
+SSE_DONE_FRAME = b"data: [DONE]"
+# Upstream bytes are taken as soon as any arrive (read1), up to SSE_READ_SIZE
+# at a time. Without read1 (urllib3 < 2) a read blocks until it is full on a
+# non-chunked response, so the fallback keeps reads small.
+SSE_READ_SIZE = 8192
+SSE_FALLBACK_READ_SIZE = 512
+
+# Cached replies are re-streamed in chunks of this size.
+REPLAY_CHUNK_SIZE = 64
+
+# Clients coalesce token deltas into fewer response chunks: a chunk is sent
+# once FLUSH_BYTES are pending or FLUSH_INTERVAL seconds after the first
+# pending byte arrived, whichever is first — never held behind an upstream pause.
+FLUSH_BYTES = 64
+FLUSH_INTERVAL = 0.02
+
+# Recent completions keyed by a hash of the canonical messages, so re-opened
+# branches / repeated popup questions replay from memory instead of re-hitting
+# Groq. Bounded LRU with a TTL; only fully completed streams are stored.
+RESPONSE_CACHE_SIZE = 512
+RESPONSE_CACHE_TTL = 600  # seconds
+_response_cache: "OrderedDict[bytes, Tuple[float, bytes]]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+# Upstream streams currently in progress, keyed like the response cache, so a
+# concurrent identical request attaches to the running stream instead of
+# starting a second one.
+_inflight: Dict[bytes, "_Broadcast"] = {}
+_inflight_lock = threading.Lock()
+
+# One pooled session shared by all three endpoints so keep-alive connections
+# to Groq are reused across requests instead of paying a TCP+TLS handshake per
+# turn. Every request goes to the same host, so a single host pool suffices.
+# Sockets skip Nagle (no delayed-ACK stalls between small token frames) and
+# keep TCP keep-alive probes on so idle pooled connections stay usable.
+UPSTREAM_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+class _UpstreamAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = UPSTREAM_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+SESSION = requests.Session()
+SESSION.mount("https://", _UpstreamAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=0))
+SESSION.headers["Authorization"] = f"Bearer {GROQ_API_KEY}"
+SESSION.headers["Content-Type"] = "application/json"
+
+# Everything in the upstream request except the messages is fixed per process.
+COMPLETIONS_URL = f"{BASE_URL}/chat/completions"
+PAYLOAD_BASE = {
+    "model": MODEL,
+    "temperature": TEMPERATURE,
+    "max_tokens": MAX_TOKENS,
+    "stream": True,
+}
+
+# Static response parts, built once instead of per response / per error.
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization",
+    "Access-Control-Allow-Methods": "POST, OPTIONS",
+}
+ERR_NO_KEY = orjson.dumps({"error": "GROQ_API_KEY missing"})
+ERR_SELECTION_REQUIRED = orjson.dumps({"error": "selection required"})
+ERR_NO_QUESTION = orjson.dumps({"error": "Provide either popup_turns or question"})
+ERR_BAD_JSON = orjson.dumps({"error": "Request body must be a JSON object"})
+ERR_UPSTREAM_UNKNOWN = orjson.dumps({"error": "Unknown error from Groq"})
+
+# Fixed prompt fragments shared by the branch endpoints.
+SELECTION_PREFIX = "Selected Context:\n"
+TRANSCRIPT_PREFIXES = {"user": "User: ", "assistant": "Assistant: "}
+
+def json_response(body: bytes, status: int) -> Response:
+    return Response(body, status=status, mimetype="application/json", headers=CORS_HEADERS)
+
+# A UTF-16 surrogate half with no partner (e.g. an emoji cut in two by the
+# frontend's .slice()); orjson can neither parse nor serialize one.
+LONE_SURROGATE = re.compile("[\ud800-\udfff]")
+
+def _scrub_surrogates(value):
+    if isinstance(value, str):
+        return LONE_SURROGATE.sub("\ufffd", value)
+    if isinstance(value, list):
+        return [_scrub_surrogates(v) for v in value]
+    if isinstance(value, dict):
+        return {_scrub_surrogates(k): _scrub_surrogates(v) for k, v in value.items()}
+    return value
+
+def _json_body() -> Optional[Dict]:
+    """
+    Parse the request body once with orjson; None if it isn't a JSON object.
+    Bodies orjson rejects are retried with the stdlib parser, which accepts
+    lone surrogate escapes; those are replaced with U+FFFD so the data can be
+    re-serialized for the cache key and upstream payload.
+    """
+    raw = request.get_data(cache=False) or b"{}"
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        try:
+            data = _scrub_surrogates(json.loads(raw))
+        except (ValueError, RecursionError):
+            return None
+    return data if isinstance(data, dict) else None
+
+def _canonicalize(messages) -> List[Dict[str, str]]:
+    """
+    Normalize client-provided turns into {role, content} dicts with a fixed key
+    order and untouched content, so the same conversation always serializes to
+    the same bytes and Groq's prompt prefix cache keeps hitting across turns.
+    Never re-strip content or add per-request data (timestamps, ids) here.
+    """
+    return [
+        {"role": m["role"], "content": m["content"]}
+        for m in messages
+        if isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("content"), str)
+    ]
 
-@app.after_request
-def after(resp):
-    return add_cors_headers(resp)
+def _trim_history(messages: List[Dict[str, str]], keep: int = 0) -> List[Dict[str, str]]:
+    """
+    Drop the oldest turns until the rest fit HISTORY_TOKEN_BUDGET, using a
+    len(content) // 4 token estimate. The newest `keep` turns always survive.
+    """
+    total = 0
+    for i in range(len(messages) - 1, -1, -1):
+        total += len(messages[i]["content"]) // 4
+        if total > HISTORY_TOKEN_BUDGET and len(messages) - i > keep:
+            return messages[i + 1:]
+    return messages
 
-@app.route("/api/chat", methods=["POST", "OPTIONS"])
+def _is_popup_turn(t) -> bool:
+    """Only user/assistant popup turns with string content are forwarded."""
+    return isinstance(t, dict) and t.get("role") in ("user", "assistant") and isinstance(t.get("content"), str)
+
+@app.before_request
+def preflight():
+    # Answer CORS preflights for known routes before dispatching to a view;
+    # unknown URLs fall through to the usual 404.
+    if request.method == "OPTIONS" and request.url_rule is not None:
+        return Response(status=204, headers=CORS_HEADERS)
+
+@app.errorhandler(HTTPException)
+def http_error(e: HTTPException) -> Response:
+    # Views attach CORS headers when building responses; only framework
+    # errors (404/405/...) need them added here, so no per-response hook runs.
+    resp = e.get_response()
+    resp.headers.update(CORS_HEADERS)
+    return resp
+
+@app.route("/api/chat", methods=["POST"])
 def chat():
-    if request.method == "OPTIONS":
-        return add_cors_headers(Response(status=204))
     if not GROQ_API_KEY:
-        return add_cors_headers(Response(json.dumps({"error": "GROQ_API_KEY missing"}), status=500, mimetype="application/json"))
+        return json_response(ERR_NO_KEY, 500)
 
-    data = request.get_json(force=True, silent=True) or {}
-    messages = data.get("messages", [])
+    data = _json_body()
+    if data is None:
+        return json_response(ERR_BAD_JSON, 400)
+    # Always keep the newest turn (the one being asked) even if it alone is over budget.
+    messages = _trim_history(_canonicalize(data.get("messages") or []), keep=1)
     # (No system prompt per spec.)
     return stream_completion(messages)
 
-@app.route("/api/branch", methods=["POST", "OPTIONS"])
+@app.route("/api/branch", methods=["POST"])
 def branch():
     """
     Multi-purpose endpoint for popup conversation turns.
@@ -88,84 +260,73 @@ def branch():
       - multi-turn : { selection, popup_turns: [{role,content}...], history }
     Always includes the selection as an anchoring context message.
     """
-    if request.method == "OPTIONS":
-        return add_cors_headers(Response(status=204))
     if not GROQ_API_KEY:
-        return add_cors_headers(Response(json.dumps({"error": "GROQ_API_KEY missing"}), status=500, mimetype="application/json"))
+        return json_response(ERR_NO_KEY, 500)
 
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
+    if data is None:
+        return json_response(ERR_BAD_JSON, 400)
     selection = (data.get("selection") or "")[:3000]
     history = data.get("history") or []
-    question = (data.get("question") or "").strip()
+    question = data.get("question") or ""
     popup_turns = data.get("popup_turns") or []  # list of {role, content}
 
     if not selection.strip():
-        return add_cors_headers(Response(json.dumps({"error": "selection required"}), status=400, mimetype="application/json"))
+        return json_response(ERR_SELECTION_REQUIRED, 400)
 
-    messages: List[Dict[str, Any]] = []
-    # Include last-N main messages as context first (provided by client)
-    for m in history:
-        if isinstance(m, dict) and "role" in m and "content" in m:
-            messages.append({"role": m["role"], "content": m["content"]})
+    # Include last-N main messages as context first (provided by client).
+    # Order: history, selection, popup turns — stable so prefixes match across turns.
+    messages = _trim_history(_canonicalize(history))
 
     # Inject the selected text as an explicit context message
-    messages.append({"role": "user", "content": f"Selected Context:\n{selection}"})
+    messages.append({"role": "user", "content": SELECTION_PREFIX + selection})
 
     # Mode A: multi-turn popup chat provided
     if popup_turns:
-        for t in popup_turns:
-            role = t.get("role")
-            content = (t.get("content") or "")
-            if role in ("user", "assistant") and isinstance(content, str):
-                messages.append({"role": role, "content": content})
+        messages.extend({"role": t["role"], "content": t["content"]} for t in popup_turns if _is_popup_turn(t))
     # Mode B: single question field
-    elif question:
+    elif question.strip():
         messages.append({"role": "user", "content": question})
     else:
-        return add_cors_headers(Response(json.dumps({"error": "Provide either popup_turns or question"}), status=400, mimetype="application/json"))
+        return json_response(ERR_NO_QUESTION, 400)
 
     return stream_completion(messages)
 
-@app.route("/api/branch/summary", methods=["POST", "OPTIONS"])
+@app.route("/api/branch/summary", methods=["POST"])
 def branch_summary():
     """
     Summarize an entire popup chat (plus selection and last-N main messages)
     into a concise, student-friendly summary to attach back to the main thread.
     Body: { selection, popup_turns: [{role,content}...], history }
     """
-    if request.method == "OPTIONS":
-        return add_cors_headers(Response(status=204))
     if not GROQ_API_KEY:
-        return add_cors_headers(Response(json.dumps({"error": "GROQ_API_KEY missing"}), status=500, mimetype="application/json"))
+        return json_response(ERR_NO_KEY, 500)
 
-    data = request.get_json(force=True, silent=True) or {}
+    data = _json_body()
+    if data is None:
+        return json_response(ERR_BAD_JSON, 400)
     selection = (data.get("selection") or "")[:3000]
     popup_turns = data.get("popup_turns") or []
     history = data.get("history") or []
 
     if not selection.strip():
-        return add_cors_headers(Response(json.dumps({"error": "selection required"}), status=400, mimetype="application/json"))
+        return json_response(ERR_SELECTION_REQUIRED, 400)
 
     # Build messages to request a crisp summary.
-    messages: List[Dict[str, str]] = []
     # Include limited main history first (same order as normal)
-    for m in history:
-        if isinstance(m, dict) and "role" in m and "content" in m:
-            messages.append({"role": m["role"], "content": m["content"]})
+    messages = _trim_history(_canonicalize(history))
 
     # Provide selected context explicitly
-    messages.append({"role": "user", "content": f"Selected Context:\n{selection}"})
+    messages.append({"role": "user", "content": SELECTION_PREFIX + selection})
 
     # Provide the popup conversation transcript
     if popup_turns:
         # Add a compact header before the transcript so the model knows what's coming
         messages.append({"role": "user", "content": "Below is the branch conversation transcript:"})
-        for t in popup_turns:
-            role = t.get("role")
-            content = (t.get("content") or "")
-            if role in ("user", "assistant") and isinstance(content, str):
-                prefix = "User:" if role == "user" else "Assistant:"
-                messages.append({"role": "user", "content": f"{prefix} {content}"})
+        messages.extend(
+            {"role": "user", "content": TRANSCRIPT_PREFIXES[t["role"]] + t["content"]}
+            for t in popup_turns if _is_popup_turn(t)
+        )
 
     # Final instruction for summarization (kept in a user message to avoid global system prompts)
     messages.append({
@@ -180,64 +341,338 @@ def branch_summary():
 
     return stream_completion(messages)
 
+def _cache_key(messages) -> bytes:
+    return hashlib.blake2b(orjson.dumps(messages), digest_size=16).digest()
+
+def _cache_get(key: bytes) -> Optional[bytes]:
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        expires, body = entry
+        if expires < time.monotonic():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return body
+
+def _cache_put(key: bytes, body: bytes) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = (time.monotonic() + RESPONSE_CACHE_TTL, body)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+def _replay(body: bytes) -> Generator[bytes, None, None]:
+    # Re-chunk cached text so the frontend still sees a streamed reply.
+    for i in range(0, len(body), REPLAY_CHUNK_SIZE):
+        yield body[i:i + REPLAY_CHUNK_SIZE]
+
+class _Broadcast:
+    """
+    Fan-out buffer for one upstream stream. A pump thread appends chunks;
+    every client (the one that started it included) replays everything so far
+    and then follows along.
+    `done` is set by the producer once upstream sent [DONE]; a broadcast closed
+    without it was cut short, and subscribers get an error rather than a
+    silently truncated reply.
+    `retired` is set (under _inflight_lock) when it leaves _inflight; no new
+    subscriber may attach after that.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.done = False
+        self.closed = False
+        self.retired = False
+        self.subscribers = 0
+        self._cond = threading.Condition()
+
+    def publish(self, chunk: bytes) -> None:
+        with self._cond:
+            self.data += chunk
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def has_subscribers(self) -> bool:
+        with self._cond:
+            return self.subscribers > 0
+
+    def subscribe(self) -> "_Subscription":
+        # Counted eagerly (not when iteration starts) so the producer sees this
+        # subscriber as soon as it is handed out.
+        with self._cond:
+            self.subscribers += 1
+        return _Subscription(self)
+
+    def unsubscribe(self) -> None:
+        with self._cond:
+            self.subscribers -= 1
+
+    def follow(self) -> Generator[bytes, None, None]:
+        offset = 0
+        while True:
+            with self._cond:
+                while offset == len(self.data) and not self.closed:
+                    self._cond.wait()
+                # Give the producer a short, bounded window to add more first.
+                deadline = time.monotonic() + FLUSH_INTERVAL
+                while len(self.data) - offset < FLUSH_BYTES and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                chunk = bytes(self.data[offset:])
+                offset = len(self.data)
+                finished = self.closed
+            if chunk:
+                yield chunk
+            if finished:
+                if not self.done:
+                    raise ConnectionAbortedError("upstream stream ended before completion")
+                return
+
+class _Subscription:
+    """
+    Iterator over a broadcast that gives its subscriber slot back once, when it
+    is exhausted, fails, or is closed — including a close() before the first
+    chunk, which a plain generator's `finally` would never see.
+    """
+
+    def __init__(self, bc: _Broadcast):
+        self._bc = bc
+        self._chunks = bc.follow()
+        self._released = False
+
+    def __iter__(self) -> "_Subscription":
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if not self._released:
+            self._released = True
+            self._chunks.close()
+            self._bc.unsubscribe()
+
+def _iter_upstream_reads(r: requests.Response) -> Iterator[bytes]:
+    """
+    Yield upstream body bytes as they arrive. iter_content() blocks until a
+    full chunk_size has been read when the response isn't chunked
+    (close-delimited, or re-framed by a proxy), holding back early tokens.
+    urllib3 errors are translated the way iter_content() does.
+    """
+    read1 = getattr(r.raw, "read1", None)
+    if read1 is None:
+        yield from r.iter_content(chunk_size=SSE_FALLBACK_READ_SIZE)
+        return
+    try:
+        while True:
+            chunk = read1(SSE_READ_SIZE, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except SSLError as e:
+        raise requests.exceptions.SSLError(e)
+
+def _iter_sse_reads(chunks) -> Generator[List[bytearray], None, None]:
+    r"""
+    Split raw upstream chunks into lines with C-level find() calls, rather
+    than a per-chunk splitlines() pass. Lines end in "\n", "\r\n" or a bare
+    "\r", as in the SSE spec. Yields, per upstream read, the lines it
+    completed (without terminators); a trailing partial line — or a "\r"
+    whose "\n" may still be in flight — is carried over to the next read.
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        lines = []
+        start = 0
+        while True:
+            nl = pending.find(b"\n", start)
+            cr = pending.find(b"\r", start, len(pending) if nl == -1 else nl)
+            if cr != -1:
+                if cr + 1 == len(pending):
+                    break  # might be the first half of a split "\r\n"
+                lines.append(pending[start:cr])
+                start = cr + 2 if pending[cr + 1] == 10 else cr + 1  # 10 == "\n"
+            elif nl != -1:
+                lines.append(pending[start:nl])
+                start = nl + 1
+            else:
+                break
+        del pending[:start]
+        yield lines
+    if pending:
+        yield [pending[:-1] if pending[-1] == 13 else pending]  # 13 == "\r"
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=1).compress(body)
+    return zlib.compress(body, 1, wbits=31)  # wbits=31 -> gzip container
+
+def stream_response(chunks: Iterator[bytes]) -> Response:
+    """Wrap a plain-text chunk stream."""
+    resp = Response(chunks, mimetype="text/plain; charset=utf-8", headers=CORS_HEADERS)
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+def cached_response(body: bytes) -> Response:
+    """
+    Replay a cached reply. If the client allows, the whole body is encoded in
+    one call; live upstream streams are never compressed, since per-token
+    flushes of a few bytes each make the encoded stream larger than the plain one.
+    """
+    encoding = request.accept_encodings.best_match(["zstd", "gzip"] if zstandard else ["gzip"])
+    if encoding is None:
+        return stream_response(_replay(body))
+    resp = Response(_compress(body, encoding), mimetype="text/plain; charset=utf-8", headers=CORS_HEADERS)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Content-Encoding"] = encoding
+    return resp
+
+def _iter_deltas(r: requests.Response, bc: _Broadcast) -> Generator[bytes, None, None]:
+    """
+    Turn Groq's SSE stream into plain-text chunks, publishing each to `bc`
+    before yielding it and setting `bc.done` on the terminal frame.
+    Deltas from one upstream read are published together; batching across
+    reads is left to the followers (see FLUSH_INTERVAL).
+    """
+    buf = bytearray()
+    for lines in _iter_sse_reads(_iter_upstream_reads(r)):
+        done = False
+        for line in lines:
+            # Terminal frame first, then skip anything that isn't a data frame
+            # (blank separators, comments); OpenAI-compatible frames are "data: {...}".
+            if line == SSE_DONE_FRAME:
+                done = True
+                break
+            if not line.startswith(SSE_DATA_PREFIX):
+                continue
+            try:
+                event = orjson.loads(line[len(SSE_DATA_PREFIX):])
+                delta = event["choices"][0]["delta"].get("content", "")
+                if delta:
+                    buf += delta.encode()
+            except Exception:
+                # Ignore malformed chunks
+                continue
+        if buf:
+            chunk = bytes(buf)
+            buf.clear()
+            bc.publish(chunk)
+            yield chunk
+        if done:
+            bc.done = True
+            return
+
 def stream_completion(messages) -> Response:
     """
     Proxies to Groq's streaming endpoint and re-streams plain text chunks,
     but only after verifying the upstream response is 200.
     If Groq returns 4xx/5xx, pass the error JSON/text to the client.
+    Identical recent requests are served from the in-process response cache.
     """
-    url = f"{BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": MODEL,
-        "messages": messages,
-        "temperature": TEMPERATURE,
-        "max_tokens": MAX_TOKENS,
-        "stream": True
-    }
+    key = _cache_key(messages)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached_response(cached)
+    with _inflight_lock:
+        running = _inflight.get(key)
+        follower = running.subscribe() if running is not None and not running.retired else None
+    if follower is not None:
+        return stream_response(follower)
+
+    payload = orjson.dumps({**PAYLOAD_BASE, "messages": messages})
 
     # Make the request first (so we can inspect status before streaming)
     try:
-        r = requests.post(url, headers=headers, json=payload, stream=True, timeout=300)
+        r = SESSION.post(COMPLETIONS_URL, data=payload, stream=True, timeout=300)
     except requests.RequestException as e:
         err = {"error": f"Network error contacting Groq: {str(e)}"}
-        return add_cors_headers(Response(json.dumps(err), status=502, mimetype="application/json"))
+        return json_response(orjson.dumps(err), 502)
 
     # If Groq says 4xx/5xx, return the error body (don’t start streaming)
     if r.status_code != 200:
         try:
-            body = r.json()
-            # Groq often uses {"error": {"message": "..."}}
-            if isinstance(body, dict) and "error" in body and isinstance(body["error"], dict) and "message" in body["error"]:
-                body = {"error": body["error"]["message"]}
-        except Exception:
-            body = {"error": (r.text or "Unknown error from Groq")}
-        return add_cors_headers(Response(json.dumps(body), status=r.status_code, mimetype="application/json"))
-
-    # OK — now stream chunks
-    def generate() -> Generator[bytes, None, None]:
-        for line in r.iter_lines(decode_unicode=True):
-            if not line:
-                continue
-            # OpenAI-compatible stream frames are prefixed with "data: "
-            if line.startswith("data: "):
-                data_str = line[len("data: "):].strip()
-                if data_str == "[DONE]":
+            raw = r.content
+        except requests.RequestException:
+            raw = b""
+        finally:
+            r.close()
+        if not raw:
+            return json_response(ERR_UPSTREAM_UNKNOWN, r.status_code)
+        try:
+            body = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # Not JSON (e.g. an HTML error page): wrap it so the frontend can show it
+            return json_response(orjson.dumps({"error": r.text}), r.status_code)
+        # Groq often uses {"error": {"message": "..."}}
+        err = body.get("error") if isinstance(body, dict) else None
+        if isinstance(err, dict) and "message" in err:
+            return json_response(orjson.dumps({"error": err["message"]}), r.status_code)
+        # Any other JSON shape is already a JSON error body: forward it as-is
+        return json_response(raw, r.status_code)
+
+    # OK — read upstream on a pump thread (a greenlet under gevent) and follow
+    # it like any coalesced request, so this client can leave without cutting
+    # the reply short for others.
+    bc = _Broadcast()
+    with _inflight_lock:
+        running = _inflight.setdefault(key, bc)
+        follower = running.subscribe()
+    if running is not bc:
+        # An identical request registered while ours was connecting: share it.
+        r.close()
+        return stream_response(follower)
+    threading.Thread(target=_pump, args=(key, r, bc), daemon=True).start()
+    return stream_response(follower)
+
+def _pump(key: bytes, r: requests.Response, bc: _Broadcast) -> None:
+    """
+    Read one upstream completion into `bc` until [DONE], an upstream error, or
+    the last follower leaving; then cache it if complete and release everything.
+    """
+    try:
+        for _ in _iter_deltas(r, bc):
+            # Checked and unregistered in one critical section: subscribe() also
+            # runs under _inflight_lock, so nobody can attach in between.
+            with _inflight_lock:
+                if not bc.has_subscribers():
+                    _retire(key, bc)
                     break
-                try:
-                    event = json.loads(data_str)
-                    delta = event["choices"][0]["delta"].get("content", "")
-                    if delta:
-                        yield delta.encode("utf-8")
-                except Exception:
-                    # Ignore malformed chunks
-                    continue
-
-    resp = Response(generate(), mimetype="text/plain; charset=utf-8")
-    return add_cors_headers(resp)
+    except requests.RequestException:
+        pass
+    finally:
+        # Only cache replies that reached [DONE]; truncated streams are not reusable.
+        # Cached before leaving _inflight so an identical request always finds one.
+        if bc.done:
+            _cache_put(key, bytes(bc.data))
+        with _inflight_lock:
+            _retire(key, bc)
+        r.close()
+        bc.close()
+
+def _retire(key: bytes, bc: _Broadcast) -> None:
+    # Caller holds _inflight_lock.
+    bc.retired = True
+    if _inflight.get(key) is bc:
+        del _inflight[key]
 
 if __name__ == "__main__":
     # For local dev only.
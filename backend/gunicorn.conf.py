@@ -0,0 +1,21 @@
+# gunicorn.conf.py
+# Production server settings for the streaming proxy. Nearly every request is
+# blocked on upstream I/O to Groq, so cooperative gevent workers hold many
+# concurrent streams per process instead of one per thread.
+#
+# Usage (from backend/):
+#   gunicorn -c gunicorn.conf.py app:app
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+# The gevent worker monkey-patches blocking I/O itself before loading the app.
+worker_class = "gevent"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2 * multiprocessing.cpu_count()))
+worker_connections = 1000
+# Client-facing keep-alive; gunicorn already sets TCP_NODELAY on its TCP
+# listener, so small streamed chunks are not held back by Nagle.
+keepalive = 75
+# Streams can legitimately run for a while; don't kill workers mid-completion.
+timeout = 300
@@ -0,0 +1,430 @@
+# test_app.py
+# Tests for the streaming proxy: fan-out of one upstream stream to concurrent
+# identical requests, response compression, request parsing, upstream reads,
+# SSE line splitting, history trimming and upstream error relaying. Groq is
+# replaced by an in-memory response.
+#
+# Run (from backend/):
+#   python -m unittest test_app
+
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+from werkzeug.test import EnvironBuilder
+
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+
+import app
+
+
+def sse_frame(delta: str) -> bytes:
+    event = {"choices": [{"delta": {"content": delta}}]}
+    return b"data: " + json.dumps(event).encode() + b"\n\n"
+
+
+class FakeUpstream:
+    """
+    Stand-in for a streamed requests.Response: one SSE frame per read. Reads
+    are held until the test allows them, so it controls what has "arrived".
+    Serves reads through raw.read1(); set `raw = None` to exercise the
+    iter_content() fallback.
+    """
+
+    status_code = 200
+
+    def __init__(self, deltas, finish=True):
+        self.reads = [sse_frame(d) for d in deltas]
+        if finish:
+            self.reads.append(b"data: [DONE]\n\n")
+        self.closed = False
+        self.served = 0
+        self._permits = threading.Semaphore(0)
+        self._pending_reads = self.iter_content()
+        self.raw = self
+
+    def allow(self, n=1):
+        for _ in range(n):
+            self._permits.release()
+
+    def allow_all(self):
+        self.allow(len(self.reads))
+
+    def iter_content(self, chunk_size=1):
+        for read in self.reads:
+            if not self._permits.acquire(timeout=5):
+                raise AssertionError("upstream read never allowed")
+            self.served += 1
+            yield read
+
+    def read1(self, amt=-1, decode_content=None):
+        return next(self._pending_reads, b"")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeErrorResponse:
+    """Stand-in for a non-200 upstream requests.Response."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+class CoalescedStreamTests(unittest.TestCase):
+    def setUp(self):
+        app._response_cache.clear()
+        app._inflight.clear()
+        self.client = app.app.test_client()
+        self.body = {"messages": [{"role": "user", "content": "explain"}]}
+
+    def start_owner_and_subscriber(self, upstream):
+        upstream.allow(1)
+        with mock.patch.object(app.SESSION, "post", return_value=upstream) as post:
+            owner = self.client.post("/api/chat", json=self.body, buffered=False)
+            owner_iter = iter(owner.response)
+            first = next(owner_iter)  # owner is now streaming and registered
+            subscriber = self.client.post("/api/chat", json=self.body, buffered=False)
+        self.assertEqual(post.call_count, 1)
+        return owner, first, subscriber
+
+    def test_subscriber_gets_full_reply_when_owner_disconnects(self):
+        tokens = [f"tok{i} " for i in range(20)]
+        upstream = FakeUpstream(tokens)
+        owner, first, subscriber = self.start_owner_and_subscriber(upstream)
+
+        self.assertEqual(first, b"tok0 ")
+        owner.close()  # owning client goes away after one chunk
+        upstream.allow_all()
+
+        self.assertEqual(subscriber.status_code, 200)
+        self.assertEqual(subscriber.get_data(), "".join(tokens).encode())
+        wait_until(lambda: app._inflight == {})
+        self.assertTrue(upstream.closed)
+        # The completed reply is cached as well.
+        self.assertEqual(app._cache_get(app._cache_key(self.body["messages"])), "".join(tokens).encode())
+
+    def test_owner_does_not_drain_after_subscriber_disconnects_first(self):
+        upstream = FakeUpstream([f"tok{i} " for i in range(20)])
+        upstream.allow(1)
+        environ = EnvironBuilder(method="POST", path="/api/chat", json=self.body).get_environ()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream):
+            owner = self.client.post("/api/chat", json=self.body, buffered=False)
+            next(iter(owner.response))
+            # Called as a WSGI server would, so the subscriber's response is
+            # handed out but never iterated (the test client always pulls one chunk).
+            subscriber = app.app(environ, lambda status, headers, exc_info=None: None)
+        bc = next(iter(app._inflight.values()))
+        self.assertEqual(bc.subscribers, 2)
+
+        subscriber.close()  # coalesced client leaves before its first chunk
+        owner.close()
+        self.assertEqual(bc.subscribers, 0)
+        upstream.allow_all()
+
+        wait_until(lambda: bc.closed)
+        self.assertLess(upstream.served, len(upstream.reads))
+        self.assertTrue(upstream.closed)
+        self.assertEqual(app._inflight, {})
+        self.assertEqual(app._response_cache, {})
+
+    def test_request_after_last_follower_left_starts_its_own_stream(self):
+        first_upstream = FakeUpstream([f"tok{i} " for i in range(5)])
+        first_upstream.allow(1)
+        with mock.patch.object(app.SESSION, "post", return_value=first_upstream):
+            owner = self.client.post("/api/chat", json=self.body, buffered=False)
+            next(iter(owner.response))
+        bc = next(iter(app._inflight.values()))
+        owner.close()
+        first_upstream.allow_all()
+        wait_until(lambda: bc.retired)
+
+        second_upstream = FakeUpstream(["fresh"])
+        second_upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=second_upstream) as post:
+            late = self.client.post("/api/chat", json=self.body)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(late.get_data(), b"fresh")
+
+    def test_followers_error_when_upstream_ends_early(self):
+        upstream = FakeUpstream(["partial ", "reply"], finish=False)
+        owner, first, subscriber = self.start_owner_and_subscriber(upstream)
+        self.assertEqual(first, b"partial ")
+        upstream.allow_all()
+
+        for follower in (owner, subscriber):
+            with self.assertRaises(ConnectionAbortedError):
+                follower.get_data()
+        self.assertEqual(app._response_cache, {})
+
+    def test_deltas_are_coalesced_into_fewer_chunks(self):
+        tokens = [f"t{i:02} " for i in range(40)]
+        upstream = FakeUpstream(tokens)
+        upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream):
+            resp = self.client.post("/api/chat", json=self.body, buffered=False)
+            chunks = list(resp.response)
+
+        self.assertEqual(b"".join(chunks), "".join(tokens).encode())
+        self.assertLess(len(chunks), len(tokens) // 4)
+
+    def test_coalescing_never_waits_for_a_paused_upstream(self):
+        upstream = FakeUpstream(["a", "b", "c"])
+        upstream.allow(2)  # "c" and [DONE] stall until released below
+        start = time.monotonic()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream):
+            resp = self.client.post("/api/chat", json=self.body, buffered=False)
+            it = iter(resp.response)
+            first = next(it)
+        elapsed = time.monotonic() - start
+        upstream.allow_all()
+
+        self.assertEqual(first, b"ab")
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(first + b"".join(it), b"abc")
+
+
+class CompressionTests(unittest.TestCase):
+    TEXT = (
+        "Photosynthesis turns light energy into chemical energy. The light "
+        "reactions make ATP and NADPH; the Calvin cycle then uses ATP and NADPH "
+        "to fix carbon dioxide into sugars. Key takeaway: light reactions power "
+        "the Calvin cycle, and the Calvin cycle builds the sugars. "
+    ) * 8
+
+    def setUp(self):
+        app._response_cache.clear()
+        app._inflight.clear()
+        self.client = app.app.test_client()
+        self.body = {"messages": [{"role": "user", "content": "summarize"}]}
+        # Token-sized deltas, the way Groq streams them.
+        self.tokens = [self.TEXT[i:i + 4] for i in range(0, len(self.TEXT), 4)]
+
+    def fetch(self):
+        upstream = FakeUpstream(self.tokens)
+        upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream):
+            return self.client.post("/api/chat", json=self.body, headers={"Accept-Encoding": "gzip"})
+
+    def test_live_stream_is_never_larger_than_plain(self):
+        plain = self.TEXT.encode()
+        resp = self.fetch()
+
+        self.assertIsNone(resp.headers.get("Content-Encoding"))
+        self.assertLessEqual(len(resp.get_data()), len(plain))
+        self.assertEqual(resp.get_data(), plain)
+
+    def test_cached_replay_is_compressed_smaller_than_plain(self):
+        plain = self.TEXT.encode()
+        first = self.fetch()
+        first.get_data()  # fills the response cache
+        # Wait for the pump to unregister, so the next request hits the cache
+        # rather than attaching to the in-flight broadcast.
+        wait_until(lambda: app._inflight == {})
+        resp = self.fetch()
+
+        self.assertEqual(resp.headers.get("Content-Encoding"), "gzip")
+        self.assertLess(len(resp.get_data()), len(plain))
+        self.assertEqual(gzip.decompress(resp.get_data()), plain)
+
+
+class RequestBodyTests(unittest.TestCase):
+    def setUp(self):
+        app._response_cache.clear()
+        app._inflight.clear()
+        self.client = app.app.test_client()
+
+    def test_lone_surrogate_in_selection_is_replaced(self):
+        # What JSON.stringify emits for an emoji cut in half by .slice().
+        body = b'{"selection": "cut \\ud83d", "question": "why?"}'
+        upstream = FakeUpstream(["ok"])
+        upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream) as post:
+            resp = self.client.post("/api/branch", data=body, content_type="application/json")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_data(), b"ok")
+        sent = json.loads(post.call_args.kwargs["data"])
+        self.assertEqual(sent["messages"][0]["content"], app.SELECTION_PREFIX + "cut \ufffd")
+
+    def test_turns_with_non_string_role_are_dropped(self):
+        nested = []
+        for _ in range(300):  # deeper than orjson.dumps will serialize
+            nested = [nested]
+        body = {"messages": [{"role": nested, "content": "x"}, {"role": "user", "content": "hi"}]}
+        upstream = FakeUpstream(["ok"])
+        upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream) as post:
+            resp = self.client.post("/api/chat", json=body)
+
+        self.assertEqual(resp.status_code, 200)
+        sent = json.loads(post.call_args.kwargs["data"])
+        self.assertEqual(sent["messages"], [{"role": "user", "content": "hi"}])
+
+    def test_popup_turns_are_filtered_and_canonicalized(self):
+        body = {
+            "selection": "text",
+            "popup_turns": [
+                {"content": "q", "role": "user", "id": 1},
+                {"role": "system", "content": "ignored"},
+                {"role": "assistant", "content": None},
+                {"role": "assistant", "content": "a"},
+            ],
+        }
+        upstream = FakeUpstream(["ok"])
+        upstream.allow_all()
+        with mock.patch.object(app.SESSION, "post", return_value=upstream) as post:
+            self.client.post("/api/branch", json=body).get_data()
+
+        sent = json.loads(post.call_args.kwargs["data"])
+        self.assertEqual(sent["messages"][1:], [{"role": "user", "content": "q"}, {"role": "assistant", "content": "a"}])
+
+    def test_preflight_only_answers_known_routes(self):
+        resp = self.client.options("/api/branch/summary")
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(resp.headers["Access-Control-Allow-Methods"], "POST, OPTIONS")
+
+        resp = self.client.options("/api/nope")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers["Access-Control-Allow-Origin"], "*")
+
+    def test_malformed_json_is_rejected(self):
+        resp = self.client.post("/api/chat", data=b"{not json", content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.get_json(), {"error": "Request body must be a JSON object"})
+
+
+class SSELineSplitTests(unittest.TestCase):
+    def split(self, *reads):
+        return [[bytes(line) for line in lines] for lines in app._iter_sse_reads(reads)]
+
+    def test_line_split_across_reads(self):
+        self.assertEqual(
+            self.split(b"data: {\"a\"", b": 1}\n\ndata: [DONE]\n"),
+            [[], [b'data: {"a": 1}', b"", b"data: [DONE]"]],
+        )
+
+    def test_crlf_split_across_reads(self):
+        # The "\r" ending one read must not produce an extra blank line.
+        self.assertEqual(self.split(b"data: x\r", b"\ndata: y\r\n"), [[], [b"data: x", b"data: y"]])
+
+    def test_bare_cr_ends_a_line(self):
+        self.assertEqual(self.split(b"data: x\rdata: y\r\r\n"), [[b"data: x", b"data: y", b""]])
+
+    def test_trailing_partial_line_is_flushed(self):
+        self.assertEqual(self.split(b"data: x\ndata: y"), [[b"data: x"], [b"data: y"]])
+        self.assertEqual(self.split(b"data: x\r"), [[], [b"data: x"]])
+
+
+class UpstreamReadTests(unittest.TestCase):
+    def test_close_delimited_upstream_streams_each_frame(self):
+        # HTTP/1.0, no Content-Length or chunking: the body ends when the
+        # socket closes, so a fixed-size read would wait for more bytes.
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+        release = threading.Event()
+
+        def serve():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(65536)
+                conn.sendall(b"HTTP/1.0 200 OK\r\nContent-Type: text/event-stream\r\n\r\n" + sse_frame("first"))
+                release.wait(5)
+                conn.sendall(sse_frame(" second") + b"data: [DONE]\n\n")
+
+        threading.Thread(target=serve, daemon=True).start()
+        url = "http://127.0.0.1:%d/" % listener.getsockname()[1]
+        with requests.get(url, stream=True, timeout=2) as r:
+            bc = app._Broadcast()
+            deltas = app._iter_deltas(r, bc)
+            self.assertEqual(next(deltas), b"first")  # before the server sends more
+            release.set()
+            self.assertEqual(b"".join(deltas), b" second")
+        self.assertTrue(bc.done)
+
+    def test_iter_content_fallback_without_read1(self):
+        upstream = FakeUpstream(["a", "b"])
+        upstream.raw = None
+        upstream.allow_all()
+        bc = app._Broadcast()
+        self.assertEqual(b"".join(app._iter_deltas(upstream, bc)), b"ab")
+        self.assertTrue(bc.done)
+
+
+class TrimHistoryTests(unittest.TestCase):
+    @staticmethod
+    def turns(*tokens):
+        # Each turn's content is sized to the given estimated token count.
+        return [{"role": "user", "content": "x" * (n * 4)} for n in tokens]
+
+    def test_oldest_turns_are_dropped_first(self):
+        messages = self.turns(3000, 2000, 1500)
+        self.assertEqual(app._trim_history(messages), messages[1:])
+
+    def test_history_under_budget_is_unchanged(self):
+        messages = self.turns(1000, 1000)
+        self.assertIs(app._trim_history(messages), messages)
+
+    def test_oversized_newest_turn_is_kept_with_keep_1(self):
+        messages = self.turns(10, app.HISTORY_TOKEN_BUDGET + 1)
+        self.assertEqual(app._trim_history(messages, keep=1), messages[1:])
+        self.assertEqual(app._trim_history(messages[1:], keep=1), messages[1:])
+        self.assertEqual(app._trim_history(messages), [])
+
+
+class UpstreamErrorTests(unittest.TestCase):
+    def setUp(self):
+        app._response_cache.clear()
+        app._inflight.clear()
+        self.client = app.app.test_client()
+        self.body = {"messages": [{"role": "user", "content": "hi"}]}
+
+    def relay(self, status, content):
+        upstream = FakeErrorResponse(status, content)
+        with mock.patch.object(app.SESSION, "post", return_value=upstream):
+            resp = self.client.post("/api/chat", json=self.body)
+        self.assertTrue(upstream.closed)
+        self.assertEqual(resp.status_code, status)
+        self.assertEqual(resp.headers["Access-Control-Allow-Origin"], "*")
+        return resp
+
+    def test_error_message_is_flattened(self):
+        resp = self.relay(429, b'{"error": {"message": "Rate limit reached", "type": "tokens"}}')
+        self.assertEqual(resp.get_json(), {"error": "Rate limit reached"})
+
+    def test_other_json_is_forwarded_unchanged(self):
+        raw = b'{"error": "model_not_found", "detail": [1, 2]}'
+        resp = self.relay(404, raw)
+        self.assertEqual(resp.get_data(), raw)
+
+    def test_non_json_body_is_wrapped(self):
+        resp = self.relay(502, b"<html>Bad gateway</html>")
+        self.assertEqual(resp.get_json(), {"error": "<html>Bad gateway</html>"})
+
+    def test_empty_body_gets_a_generic_error(self):
+        resp = self.relay(500, b"")
+        self.assertEqual(resp.get_json(), {"error": "Unknown error from Groq"})
+
+
+if __name__ == "__main__":
+    unittest.main()